@@ -0,0 +1,57 @@
+# app/ocr.py
+#
+# Рендер и OCR одной страницы. Модуль импортируется процессами пула OCR,
+# поэтому при импорте ничего не делает: ни .env, ни каталогов, ни логов,
+# ни брокера — все настройки приходят аргументами из app.workers.
+from typing import List, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image
+import pytesseract
+
+
+def init_worker(tesseract_cmd: str):
+    """initializer процесса пула: путь к tesseract.exe из настроек родителя."""
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+def render_page_to_image(doc: "fitz.Document", page_number: int, dpi: int,
+                         max_side_px: int, grayscale: bool = True) -> Image.Image:
+    page = doc.load_page(page_number)
+    zoom = dpi / 72.0
+    # большие форматы (A2, A0, чертежи) ограничиваем по длинной стороне — OCR пропорционален пикселям;
+    # A4/A3 при 300 DPI под порог не попадают
+    max_side = max(page.rect.width, page.rect.height) * zoom
+    if max_side > max_side_px:
+        zoom *= max_side_px / max_side
+    mat = fitz.Matrix(zoom, zoom)
+    # tesseract всё равно переводит в оттенки серого: рендерим сразу в L (в 3 раза меньше байт)
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=mat, alpha=False, colorspace=colorspace)
+    # сырые сэмплы pixmap сразу в PIL — без PNG-кодирования/декодирования
+    mode = "RGB" if pix.n >= 3 else "L"
+    img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    # frombytes не несёт разрешения (PNG из get_pixmap нёс): без него tesseract считает 0 dpi
+    # и ошибается с физическим размером страницы в searchable PDF. Берём итоговый zoom.
+    img.info["dpi"] = (72 * zoom, 72 * zoom)
+    return img
+
+def ocr_image_to_text_and_pdf(img: Image.Image, lang: str, config: str) -> Tuple[str, bytes]:
+    # Один запуск tesseract: searchable PDF, текст берём из его невидимого слоя
+    pdf_bytes = pytesseract.image_to_pdf_or_hocr(img, extension="pdf", lang=lang, config=config)
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        txt = "\n".join(page.get_text("text") for page in doc)
+    return txt, pdf_bytes
+
+def ocr_pages(file_path: str, pages: List[int], dpi: int, lang: str, config: str,
+              max_side_px: int, grayscale: bool) -> List[Tuple[int, str, bytes]]:
+    """
+    Выполняется в процессе пула: PDF открывается один раз на пачку страниц
+    и закрывается сразу после (чтобы не держать исходник заблокированным).
+    """
+    results = []
+    with fitz.open(file_path) as doc:
+        for n in pages:
+            img = render_page_to_image(doc, n, dpi, max_side_px, grayscale)
+            txt, pdf_bytes = ocr_image_to_text_and_pdf(img, lang, config)
+            results.append((n, txt, pdf_bytes))
+    return results
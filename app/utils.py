@@ -1,4 +1,4 @@
-import os, re, time, hashlib, pathlib, shutil
+import os, re, errno, hashlib, pathlib, shutil, functools
 from loguru import logger
 from dotenv import load_dotenv
 
@@ -17,36 +17,35 @@ pathlib.Path(LOG_DIR).mkdir(parents=True, exist_ok=True)
 
 logger.add(os.path.join(LOG_DIR, "dococr.log"), rotation="10 MB", retention=10)
 
-SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+")
+SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+", re.ASCII)
 
 def safe_basename(p: str) -> str:
     base = os.path.basename(p)
+    if not SAFE_NAME_RE.search(base):
+        return base
     return SAFE_NAME_RE.sub("_", base)
 
+@functools.lru_cache(maxsize=4096)
 def unique_stem(p: str) -> str:
-    stem = pathlib.Path(p).stem
-    h = hashlib.sha1(p.encode("utf-8")).hexdigest()[:8]
+    # чистые строковые операции (без pathlib); 8 hex-символов — blake2b с digest_size=4
+    stem = os.path.splitext(os.path.basename(p))[0]
+    h = hashlib.blake2b(p.encode("utf-8"), digest_size=4).hexdigest()
     return f"{stem}_{h}"
 
 def move_to_err(src: str, reason: str) -> None:
     try:
         target = os.path.join(ERR_DIR, safe_basename(src))
-        shutil.move(src, target)
+        try:
+            # ERR_DIR обычно на том же томе, что и IN_DIR — это один атомарный rename
+            os.replace(src, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(src, target)  # другой том: копирование + удаление
         logger.error(f"Moved to ERR: {src} -> {target}. Reason: {reason}")
     except Exception as e:
         logger.exception(f"Failed to move to ERR: {src}. Reason: {reason}. Error: {e}")
 
-def is_ready(file_path: str, wait_sec: float = 0.5) -> bool:
-    """
-    Простейшая проверка «дозаписи»: размер файла не меняется в течение wait_sec.
-    """
-    try:
-        s1 = os.path.getsize(file_path)
-        time.sleep(wait_sec)
-        s2 = os.path.getsize(file_path)
-        return s1 == s2
-    except FileNotFoundError:
-        return False
-
 def ext_lower(p: str) -> str:
-    return pathlib.Path(p).suffix.lower()
+    # без создания Path на каждый файл; у dotfile вроде ".pdf" расширения нет
+    return os.path.splitext(p)[1].lower()
@@ -1,36 +1,47 @@
 import os
+import re
 import time
 import stat
+import queue
 import threading
+import concurrent.futures
 import pathlib
+from collections import OrderedDict
 from pathlib import Path
+from typing import Container, Optional
 from watchdog.observers import Observer
 from watchdog.events import (
-    FileSystemEventHandler, FileCreatedEvent, FileMovedEvent,
+    FileSystemEventHandler, FileCreatedEvent, FileMovedEvent, FileClosedEvent,
     DirCreatedEvent, DirMovedEvent
 )
 from loguru import logger
 from dotenv import load_dotenv
 
-from .utils import IN_DIR, is_ready, ext_lower
-from .workers import ocr_file
+from .utils import IN_DIR, ext_lower
+from .workers import send_ocr_batch
 
 load_dotenv()
 
 SUPPORTED = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}
 
 # Настройки (можно задать в .env)
-DIR_SETTLE_SEC     = float(os.getenv("DIR_SETTLE_SEC", "2"))    # задержка перед сканом созданной папки
+DIR_SETTLE_SEC     = float(os.getenv("DIR_SETTLE_SEC", "2"))    # сколько каталог должен «молчать» перед сканом
+MAX_SETTLE_SEC     = float(os.getenv("MAX_SETTLE_SEC", "30"))   # но не дольше этого с первого события
 FILE_WAIT_RETRIES  = int(os.getenv("FILE_WAIT_RETRIES", "40"))  # 40*0.5 = ~20 секунд
 FILE_WAIT_STEP     = float(os.getenv("FILE_WAIT_STEP", "0.5"))
+ENQUEUE_BATCH      = int(os.getenv("ENQUEUE_BATCH", "256"))     # сколько сообщений за один pipeline в Redis
+SCAN_WORKERS       = int(os.getenv("SCAN_WORKERS", "4"))        # потоков для сканов каталогов после debounce
 FOLLOW_REPARSE     = os.getenv("FOLLOW_REPARSE", "0") == "1"    # если 1 — заходить в reparse (джанкшены/симлинки)
+WATCH_INTERVAL     = int(os.getenv("WATCH_INTERVAL", "60"))     # период опроса (сек) для сетевых IN_DIR
 # простые исключения каталогов по имени (без учёта регистра)
 EXCLUDE_DIRS = {s.strip().lower() for s in os.getenv(
     "EXCLUDE_DIRS",
     "$recycle.bin,System Volume Information,__pycache__,.git"
 ).split(",") if s.strip()}
 
-_seen_paths: set[str] = set()
+# LRU уже поставленных путей: при переполнении вытесняем самый старый, а не всё сразу
+_SEEN_MAX = 50000
+_seen_paths: "OrderedDict[str, None]" = OrderedDict()
 _seen_lock = threading.Lock()
 
 def _norm(path: str) -> str:
@@ -40,35 +51,101 @@ def _mark_enqueued_once(path: str) -> bool:
     norm = _norm(path)
     with _seen_lock:
         if norm in _seen_paths:
+            _seen_paths.move_to_end(norm)
             return False
-        _seen_paths.add(norm)
-        if len(_seen_paths) > 50000:
-            _seen_paths.clear()
+        _seen_paths[norm] = None
+        if len(_seen_paths) > _SEEN_MAX:
+            _seen_paths.popitem(last=False)
         return True
 
-def _wait_until_ready(path: str) -> bool:
+def _unmark_enqueued(path: str):
+    with _seen_lock:
+        _seen_paths.pop(_norm(path), None)
+
+def _enqueue_ready_many(candidates: list[tuple[str, Optional[int]]], wait: bool = True):
+    """
+    Пачка файлов (обычно один каталог): общее ожидание «дозаписи» — одна пауза
+    FILE_WAIT_STEP на всю пачку, а не на каждый файл, — и отправка готовых
+    пачками по ENQUEUE_BATCH одним pipeline в Redis.
+    candidates — (путь, известный размер или None).
+    wait=False — файлы заведомо дописаны (пришёл close-after-write), ждать не нужно.
+    """
+    pending: dict[str, Optional[int]] = {}
+    for path, size in candidates:
+        if not _mark_enqueued_once(path):
+            logger.debug(f"Duplicate skipped: {path}")
+            continue
+        if not wait:
+            pending[path] = None
+            continue
+        if size is None:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                pass
+        pending[path] = size
+
+    if not wait:
+        _send_paths(list(pending))
+        return
+
+    # размер с прошлой итерации переиспользуем: N попыток = N+1 stat вместо 2N
     for _ in range(FILE_WAIT_RETRIES):
-        if is_ready(path, wait_sec=FILE_WAIT_STEP):
-            return True
+        if not pending:
+            break
         time.sleep(FILE_WAIT_STEP)
-    return False
+        ready: list[str] = []
+        for path, prev in list(pending.items()):
+            try:
+                cur = os.stat(path).st_size
+            except OSError:
+                cur = None
+            if cur is not None and cur == prev:
+                del pending[path]
+                ready.append(path)
+            else:
+                pending[path] = cur
+        _send_paths(ready)
 
-def _enqueue_file(path: str):
-    ext = ext_lower(path)
-    if ext not in SUPPORTED:
-        logger.debug(f"Skip unsupported: {path}")
-        return
-    if not os.path.isfile(path):
-        logger.debug(f"Skip non-file: {path}")
-        return
-    if not _mark_enqueued_once(path):
-        logger.debug(f"Duplicate skipped: {path}")
-        return
-    if not _wait_until_ready(path):
+    for path in pending:
+        # снимаем отметку: иначе последующий close/повторный скан сочтёт файл дублем
+        _unmark_enqueued(path)
         logger.warning(f"File not ready, skipping: {path}")
-        return
-    logger.info(f"Enqueue: {path}")
-    ocr_file.send(path)
+
+def _send_paths(paths: list[str]):
+    for i in range(0, len(paths), ENQUEUE_BATCH):
+        chunk = paths[i:i + ENQUEUE_BATCH]
+        for path in chunk:
+            logger.info(f"Enqueue: {path}")
+        send_ocr_batch(chunk)
+
+def _enqueue_files(paths: list[str], wait: bool = True):
+    candidates: list[tuple[str, Optional[int]]] = []
+    for path in paths:
+        ext = ext_lower(path)
+        if ext not in SUPPORTED:
+            logger.debug(f"Skip unsupported: {path}")
+            continue
+        if not os.path.isfile(path):
+            logger.debug(f"Skip non-file: {path}")
+            continue
+        candidates.append((path, None))
+    _enqueue_ready_many(candidates, wait=wait)
+
+def _file_entry_candidate(entry: os.DirEntry) -> Optional[tuple[str, int]]:
+    """Фильтр как в _enqueue_files, но тип и размер файла берём из DirEntry (без лишних stat)."""
+    ext = ext_lower(entry.name)
+    if ext not in SUPPORTED:
+        logger.debug(f"Skip unsupported: {entry.path}")
+        return None
+    try:
+        if not entry.is_file():
+            logger.debug(f"Skip non-file: {entry.path}")
+            return None
+        return entry.path, entry.stat().st_size
+    except OSError:
+        logger.debug(f"Skip non-file: {entry.path}")
+        return None
 
 # --- Работа с reparse points (симлинки/джанкшены) на Windows ---
 
@@ -88,58 +165,295 @@ def is_reparse_point(p: Path) -> bool:
         # Если не смогли прочитать — не рискуем, считаем reparse
         return True
 
-def _should_skip_dir(parent: str, name: str) -> bool:
-    """Решаем, заходить ли в подкаталог name под parent."""
-    full = Path(parent) / name
+def _should_skip_dir_entry(entry: os.DirEntry) -> bool:
+    """Решаем, заходить ли в подкаталог entry (данные берём из DirEntry, без лишних stat)."""
     # исключения по имени
-    if name.lower() in EXCLUDE_DIRS:
+    if entry.name.lower() in EXCLUDE_DIRS:
         return True
     # симлинк?
     try:
-        if full.is_symlink():
+        if entry.is_symlink():
             return not FOLLOW_REPARSE
     except OSError:
         return True
     # reparse (включает джанкшены/mount points)
     try:
-        if is_reparse_point(full):
-            return not FOLLOW_REPARSE
+        st = entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        return False
     except OSError:
         return True
+    attrs = getattr(st, "st_file_attributes", 0)
+    FILE_ATTRIBUTE_REPARSE_POINT = getattr(stat, "FILE_ATTRIBUTE_REPARSE_POINT", 0x0400)
+    if attrs & FILE_ATTRIBUTE_REPARSE_POINT:
+        return not FOLLOW_REPARSE
     return False
 
-def _walk_onerror(err: OSError):
-    # os.walk передаст исключение сюда — логируем и продолжаем обход
-    # err.filename может быть None; используем repr(err) на всякий
-    target = getattr(err, "filename", None) or "unknown"
-    logger.warning(f"os.walk error at {target}: {err!r}")
+def _scan(dir_path: str, visited: set[tuple[int, int]]):
+    """
+    Один уровень обхода через os.scandir: файлы ставим в очередь,
+    в оставленные подкаталоги спускаемся рекурсивно.
+    visited — (st_dev, st_ino) уже пройденных каталогов: при FOLLOW_REPARSE=1
+    симлинк/джанкшен может вести наверх (link -> ..) или в уже обойденную ветку.
+    """
+    try:
+        st = os.stat(dir_path)
+    except OSError as e:
+        logger.warning(f"os.stat error at {dir_path}: {e!r}")
+        return
+    if st.st_ino:  # 0 — ФС не сообщает inode, отслеживать нечем
+        key = (st.st_dev, st.st_ino)
+        if key in visited:
+            logger.info(f"Skip directory (already visited): {dir_path}")
+            return
+        visited.add(key)
+
+    subdirs: list[str] = []
+    files: list[tuple[str, Optional[int]]] = []
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    # is_dir() с переходом по ссылке: симлинк на каталог тоже каталог,
+                    # а решение «заходить ли» принимает _should_skip_dir_entry
+                    if entry.is_dir():
+                        if _should_skip_dir_entry(entry):
+                            logger.info(f"Skip directory: {entry.path}")
+                        else:
+                            subdirs.append(entry.path)
+                        continue
+                except OSError as e:
+                    logger.warning(f"Skip entry (error): {entry.path} :: {e}")
+                    continue
+                candidate = _file_entry_candidate(entry)
+                if candidate is not None:
+                    files.append(candidate)
+    except OSError as e:
+        # PermissionError и пр. — логируем и продолжаем обход
+        target = getattr(e, "filename", None) or dir_path
+        logger.warning(f"os.scandir error at {target}: {e!r}")
+        return
+
+    # файлы каталога — одной пачкой: общее ожидание дозаписи и pipeline в Redis
+    _enqueue_ready_many(files)
+
+    # итератор уже закрыт — рекурсия не держит открытыми дескрипторы каталогов
+    for sub in subdirs:
+        _scan(sub, visited)
 
 def _enqueue_tree(root: str):
     """
-    Рекурсивный обход с pruning:
+    Рекурсивный обход через os.scandir с pruning:
     - не заходим в reparse-каталоги (симлинки/джанкшены) если FOLLOW_REPARSE=0,
     - игнор EXCLUDE_DIRS,
-    - безопасная обработка PermissionError через onerror.
+    - безопасная обработка PermissionError (логируем и идём дальше).
     """
     if not os.path.isdir(root):
         return
+    _scan(root, set())
+
+# --- Выбор observer: сетевые ФС не присылают события надёжно ---
+
+NETWORK_FSTYPES = {"nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "fuse.sshfs"}
+
+def _unescape_mount(field: str) -> str:
+    # /proc/mounts экранирует пробелы и пр. как \040 (восьмеричный код)
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+def is_network_path(path: str) -> bool:
+    """
+    True, если path лежит на сетевом томе (SMB/CIFS/NFS).
+    Windows: UNC-путь или диск типа DRIVE_REMOTE; POSIX: fstype точки монтирования из /proc/mounts.
+    При любой ошибке определения — False (обычный Observer).
+    """
+    full = os.path.abspath(path)
+    if os.name == "nt":
+        if full.startswith("\\\\"):
+            return True
+        try:
+            import ctypes
+            DRIVE_REMOTE = 4
+            drive = os.path.splitdrive(full)[0] + "\\"
+            return ctypes.windll.kernel32.GetDriveTypeW(ctypes.c_wchar_p(drive)) == DRIVE_REMOTE
+        except Exception:
+            return False
+
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return False
+    real = os.path.realpath(full)
+    best, best_type = "", ""
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        mnt = _unescape_mount(fields[1])
+        prefix = mnt.rstrip("/") + "/"
+        if (real == mnt or real.startswith(prefix)) and len(mnt) >= len(best):  # при наложении монтирований побеждает последнее
+            best, best_type = mnt, fields[2]
+    return best_type.lower() in NETWORK_FSTYPES
+
+def _emits_close_write(observer) -> bool:
+    # FileClosedEvent в watchdog есть только у inotify (Linux); на Windows — ожидание дозаписи
+    try:
+        from watchdog.observers.inotify import InotifyObserver
+    except Exception:
+        return False
+    return isinstance(observer, InotifyObserver)
+
+def _make_observer():
+    if is_network_path(IN_DIR):
+        from watchdog.observers.polling import PollingObserver
+        logger.info(f"IN_DIR is on a network volume — using PollingObserver (every {WATCH_INTERVAL}s)")
+        return PollingObserver(timeout=WATCH_INTERVAL)
+    return Observer()
+
+# --- Debounce: пачка событий → один скан ---
+#
+# Handler только кладёт события в очередь; единственный поток _debounce_loop
+# копит их и, когда каталог «затих» на DIR_SETTLE_SEC, делает один проход.
+# События внутри каталога, для которого уже ждёт полный скан, поглощаются им.
+
+_events: "queue.Queue[tuple[str, str, float]]" = queue.Queue()   # (kind, path, deadline)
+
+def _schedule(kind: str, path: str):
+    # "closed" — файл уже дописан и закрыт: копить нечего, отдаём сразу
+    delay = 0.0 if kind == "closed" else DIR_SETTLE_SEC
+    _events.put((kind, path, time.monotonic() + delay))
+
+def _pending_ancestor(norm: str, pending_dirs: Container[str]) -> Optional[str]:
+    """Ближайший каталог из pending_dirs, совпадающий с norm или содержащий его."""
+    cur = norm
+    while True:
+        if cur in pending_dirs:
+            return cur
+        parent = os.path.dirname(cur)
+        if parent == cur:
+            return None
+        cur = parent
+
+# --- Ограниченный пул сканов ---
+#
+# Сработавшие сканы уходят в пул из SCAN_WORKERS потоков, чтобы долгий обход
+# не блокировал приём событий. Ещё не начатый скан поглощает вложенные в него:
+# новый корень внутри запланированного отбрасывается, запланированные внутри
+# нового корня отменяются. Уже идущий скан мог пройти мимо нового подкаталога,
+# поэтому с ним не дедуплицируем (повторы файлов отсечёт _mark_enqueued_once).
+
+_scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="scan")
+_scheduled_roots: dict[str, concurrent.futures.Future] = {}   # norm корня → ещё не начатый скан
+_roots_lock = threading.Lock()
+
+def _submit_scan(path: str):
+    norm = _norm(path)
+    with _roots_lock:
+        anc = _pending_ancestor(norm, _scheduled_roots)
+        if anc is not None:
+            logger.debug(f"Scan of {path} covered by scheduled scan of {anc}")
+            return
+        prefix = norm.rstrip(os.sep) + os.sep
+        for root in [r for r in _scheduled_roots if r.startswith(prefix)]:
+            if _scheduled_roots[root].cancel():
+                del _scheduled_roots[root]
+        _scheduled_roots[norm] = _scan_pool.submit(_deferred_scan_bounded, norm, path)
+
+def _deferred_scan_bounded(norm: str, path: str):
+    with _roots_lock:
+        _scheduled_roots.pop(norm, None)   # скан начался — новые вложенные события им уже не покрыты
+    logger.info(f"Directory settled, scanning: {path}")
+    try:
+        _enqueue_tree(path)
+    except Exception as e:
+        logger.exception(f"Scan failed for {path}: {e}")
+
+def _submit_files(paths: list[str], wait: bool):
+    def run():
+        try:
+            _enqueue_files(paths, wait=wait)
+        except Exception as e:
+            logger.exception(f"Enqueue failed for {len(paths)} file(s): {e}")
+    if not wait:
+        # close-after-write: только stat и отправка — сразу в потоке debounce,
+        # а не в очередь пула за сканами и ожиданием дозаписи (до ~20 с каждое)
+        run()
+        return
+    _scan_pool.submit(run)
+
+def _debounce_loop():
+    dirs: dict[str, str] = {}                       # norm каталога → путь для скана
+    files: dict[tuple[str, str], dict[str, str]] = {}   # ("file"|"closed", norm родителя) → {norm файла: путь}
+    deadlines: dict[tuple[str, str], float] = {}        # ("dir"|"file"|"closed", norm каталога) → дедлайн
+    first_seen: dict[tuple[str, str], float] = {}       # тот же ключ → время первого события
 
-    for dirpath, dirnames, filenames in os.walk(root, topdown=True, followlinks=False, onerror=_walk_onerror):
-        # Pruning: выкидываем нежелательные подкаталоги до входа в них
-        kept: list[str] = []
-        for d in dirnames:
+    def push(key: tuple[str, str], deadline: float, since: Optional[float] = None):
+        # ждём тишины, но не дольше MAX_SETTLE_SEC с первого события:
+        # «горячий» каталог (сканер пишет постранично) всё равно будет обработан
+        # дедлайн только отодвигается: событие "closed" (дедлайн = сейчас) внутри
+        # ожидающего каталога не должно запускать его скан досрочно
+        start = first_seen.setdefault(key, time.monotonic() if since is None else since)
+        deadlines[key] = min(max(deadlines.get(key, 0.0), deadline), start + MAX_SETTLE_SEC)
+
+    def drop(key: tuple[str, str]) -> Optional[float]:
+        deadlines.pop(key, None)
+        return first_seen.pop(key, None)
+
+    def absorb(kind: str, path: str, deadline: float):
+        norm = _norm(path)
+        if kind == "dir":
+            anc = _pending_ancestor(norm, dirs)
+            if anc is not None:
+                push(("dir", anc), deadline)   # каталог ещё «шумит» — откладываем
+                return
+            # новый скан покрывает всё, что уже ждёт внутри него (и наследует самое раннее событие)
+            prefix = norm.rstrip(os.sep) + os.sep
+            since: Optional[float] = None
+            absorbed = [("dir", d) for d in dirs if d.startswith(prefix)]
+            absorbed += [k for k in files if k[1] == norm or k[1].startswith(prefix)]
+            for key in absorbed:
+                if key[0] == "dir":
+                    del dirs[key[1]]
+                else:
+                    del files[key]
+                started = drop(key)
+                if started is not None and (since is None or started < since):
+                    since = started
+            dirs[norm] = path
+            push(("dir", norm), deadline, since)
+        else:
+            parent = os.path.dirname(norm)
+            anc = _pending_ancestor(parent, dirs)
+            if anc is not None:
+                push(("dir", anc), deadline)
+                return
+            files.setdefault((kind, parent), {})[norm] = path
+            push((kind, parent), deadline)
+
+    while True:
+        timeout = None
+        if deadlines:
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic())
+        try:
+            absorb(*_events.get(timeout=timeout))
+            while True:  # выбираем всё, что накопилось, одним заходом
+                absorb(*_events.get_nowait())
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        for key in [k for k, dl in deadlines.items() if dl <= now]:
+            drop(key)
+            kind, norm = key
             try:
-                if _should_skip_dir(dirpath, d):
-                    logger.info(f"Skip directory: {os.path.join(dirpath, d)}")
-                    continue
-                kept.append(d)
+                if kind == "dir":
+                    _submit_scan(dirs.pop(norm))
+                else:
+                    _submit_files(list(files.pop(key).values()), wait=(kind != "closed"))
             except Exception as e:
-                logger.warning(f"Skip directory (error): {os.path.join(dirpath, d)} :: {e}")
-        dirnames[:] = kept  # важно — влияет на дальнейшую рекурсию os.walk
+                logger.exception(f"Debounced {kind} dispatch failed for {norm}: {e}")
 
-        # файлы текущей папки
-        for name in filenames:
-            _enqueue_file(os.path.join(dirpath, name))
+def _start_debouncer():
+    threading.Thread(target=_debounce_loop, name="debounce", daemon=True).start()
 
 # --- Watchdog обработчик событий ---
 
@@ -147,29 +461,33 @@ class Handler(FileSystemEventHandler):
     def on_created(self, event):
         try:
             if isinstance(event, DirCreatedEvent):
-                logger.info(f"Directory created: {event.src_path} — will scan after {DIR_SETTLE_SEC}s")
-                threading.Thread(target=self._deferred_scan, args=(event.src_path,), daemon=True).start()
+                logger.info(f"Directory created: {event.src_path} — will scan after {DIR_SETTLE_SEC}s of quiet")
+                _schedule("dir", event.src_path)
             elif isinstance(event, FileCreatedEvent):
-                self._maybe_enqueue_file(event.src_path)
+                # даже при close-событиях: inotify отдаёт IN_MOVED_TO «извне» и хардлинки
+                # как FileCreatedEvent без последующего close; дубль с on_closed отсечёт
+                # _mark_enqueued_once
+                _schedule("file", event.src_path)
         except Exception as e:
             logger.exception(f"on_created error for {getattr(event, 'src_path', '?')}: {e}")
 
     def on_moved(self, event):
         try:
             if isinstance(event, DirMovedEvent):
-                logger.info(f"Directory moved to: {event.dest_path} — will scan after {DIR_SETTLE_SEC}s")
-                threading.Thread(target=self._deferred_scan, args=(event.dest_path,), daemon=True).start()
+                logger.info(f"Directory moved to: {event.dest_path} — will scan after {DIR_SETTLE_SEC}s of quiet")
+                _schedule("dir", event.dest_path)
             elif isinstance(event, FileMovedEvent):
-                self._maybe_enqueue_file(event.dest_path)
+                _schedule("file", event.dest_path)
         except Exception as e:
             logger.exception(f"on_moved error for {getattr(event, 'dest_path', '?')}: {e}")
 
-    def _maybe_enqueue_file(self, path: str):
-        _enqueue_file(path)
-
-    def _deferred_scan(self, dir_path: str):
-        time.sleep(DIR_SETTLE_SEC)
-        _enqueue_tree(dir_path)
+    def on_closed(self, event):
+        # close-after-write (inotify): файл дописан — в очередь без опроса размера
+        try:
+            if isinstance(event, FileClosedEvent):
+                _schedule("closed", event.src_path)
+        except Exception as e:
+            logger.exception(f"on_closed error for {getattr(event, 'src_path', '?')}: {e}")
 
 def initial_recursive_scan():
     if not os.path.isdir(IN_DIR):
@@ -182,8 +500,11 @@ def main():
     initial_recursive_scan()  # разовый скан уже имеющихся файлов
 
     logger.info(f"Watching (recursive): {IN_DIR}  | FOLLOW_REPARSE={int(FOLLOW_REPARSE)}")
+    _start_debouncer()
+    observer = _make_observer()
+    if _emits_close_write(observer):
+        logger.info("Close-after-write events available — written files are enqueued on close, without size polling")
     event_handler = Handler()
-    observer = Observer()
     observer.schedule(event_handler, IN_DIR, recursive=True)
     observer.start()
     try:
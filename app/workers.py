@@ -1,8 +1,11 @@
 # app/workers.py
 import os
-import io
 import re
+import shutil
+import threading
+import multiprocessing
 import concurrent.futures
+from uuid import uuid4
 from typing import List, Optional, Tuple
 
 import fitz  # PyMuPDF
@@ -12,9 +15,11 @@ from loguru import logger
 import dramatiq
 from dramatiq.brokers.redis import RedisBroker
 from dramatiq.middleware import TimeLimit
+from dramatiq.common import current_millis
 from dotenv import load_dotenv
 
 from .utils import IN_DIR, OUT_DIR, move_to_err, unique_stem, ext_lower
+from . import ocr
 
 load_dotenv()
 
@@ -25,6 +30,8 @@ redis_url     = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 tesseract_exe = os.getenv("TESSERACT_EXE", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
 if os.path.exists(tesseract_exe):
     pytesseract.pytesseract.tesseract_cmd = tesseract_exe
+# параллелим процессами — OpenMP внутри tesseract только мешает (наследуется дочерними процессами)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
 OCR_LANG         = os.getenv("OCR_LANG", "eng")
 OUTPUT_TXT       = os.getenv("OUTPUT_TXT", "1") == "1"
@@ -33,6 +40,8 @@ TESSERACT_CONFIG = os.getenv("TESSERACT_CONFIG", "--psm 6")
 OCR_THREADS      = int(os.getenv("OCR_THREADS", "2"))
 OCR_DPI          = int(os.getenv("OCR_DPI", "300"))     # DPI для OCR только скан-страниц
 TEXT_MIN_CHARS   = int(os.getenv("TEXT_MIN_CHARS", "16"))  # порог «есть текст на странице»
+OCR_MAX_SIDE_PX  = int(os.getenv("OCR_MAX_SIDE_PX", "5000"))  # предел длинной стороны рендера (px)
+OCR_COLORSPACE   = os.getenv("OCR_COLORSPACE", "gray").lower()  # gray | rgb (цветные сканы в выходном PDF)
 
 SUPPORTED = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}
 
@@ -47,18 +56,21 @@ broker.add_middleware(TimeLimit(time_limit=8 * 60 * 60 * 1000))  # 8 часов
 # --------------------------
 # Текстовые утилиты
 # --------------------------
-_ws_re        = re.compile(r"[ \t\u00A0]+")
-_hyphen_re    = re.compile(r"(\w)-\s*\n(\w)")
+_spaces_re    = re.compile(r" {2,}", re.ASCII)   # NBSP/таб заранее заменены на пробел
+_hyphen_re    = re.compile(r"(\w)-\s*\n(\w)")    # \w остаётся Unicode: кириллические переносы
 _single_nl_re = re.compile(r"(?<!\n)\n(?!\n)")   # одиночный \n, не часть \n\n
 _multi_nl_re  = re.compile(r"\n{3,}")            # 3+ переводов → 2
 
 def preprocess_text_layer(text: str) -> str:
     if not text:
         return ""
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = _hyphen_re.sub(r"\1\2", text)        # убираем переносы по дефису
+    # str.replace без совпадений не копирует строку; NBSP и таб сводим к пробелу,
+    # чтобы дальше сжимать только настоящие серии пробелов, а не каждый пробел между словами
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\u00A0", " ").replace("\t", " ")
+    if "-" in text:
+        text = _hyphen_re.sub(r"\1\2", text)    # убираем переносы по дефису
     text = _single_nl_re.sub(" ", text)         # одиночный \n превращаем в пробел
-    text = _ws_re.sub(" ", text)                # сжимаем пробелы (вкл. NBSP)
+    text = _spaces_re.sub(" ", text)            # сжимаем пробелы (вкл. NBSP)
     text = _multi_nl_re.sub("\n", text)       # абзацы нормализуем к двум \n
     return text.strip()
 
@@ -73,30 +85,42 @@ def extract_text_from_page(page) -> str:
     return "\n\n".join([p for p in parts if p])
 
 def page_has_text(page: "fitz.Page", min_chars: int = TEXT_MIN_CHARS) -> bool:
-    txt = page.get_text("text", sort=True)
-    if len(re.sub(r"\s+", "", txt)) >= min_chars:
-        return True
-    d = page.get_text("rawdict")
-    for b in d.get("blocks", []):
-        if b.get("type") == 0:
-            for line in b.get("lines", []):
-                for span in line.get("spans", []):
-                    if span.get("text") and len(span["text"].strip()) > 0:
-                        return True
-    return False
-
-def render_page_to_image(pdf_path: str, page_number: int, dpi: int = OCR_DPI) -> Image.Image:
-    with fitz.open(pdf_path) as doc:
-        page = doc.load_page(page_number)
-        zoom = dpi / 72.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        return Image.open(io.BytesIO(pix.tobytes("png")))
-
-def ocr_image_to_text_and_pdf(img: Image.Image) -> Tuple[str, bytes]:
-    txt = pytesseract.image_to_string(img, lang=OCR_LANG, config=TESSERACT_CONFIG)
-    pdf_bytes = pytesseract.image_to_pdf_or_hocr(img, extension="pdf", lang=OCR_LANG, config=TESSERACT_CONFIG)
-    return txt, pdf_bytes
+    # Одна строка get_text("text") без сортировки и без rawdict (глиф-уровень дорог на сканах);
+    # split/join считает непробельные символы на стороне C.
+    txt = page.get_text("text")
+    return len("".join(txt.split())) >= min_chars
+
+# --------------------------
+# Пул процессов для OCR скан-страниц
+# Рендер в PyMuPDF держит GIL, поэтому страницы раскидываем по процессам.
+# Пул общий для всех потоков актора и создаётся лениво (watcher его не поднимает).
+# Процессы стартуют через spawn (родитель — многопоточный dramatiq) и импортируют
+# только app.ocr — без побочных эффектов app.utils/app.workers (лог, брокер).
+# --------------------------
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=OCR_THREADS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ocr.init_worker,
+                initargs=(pytesseract.pytesseract.tesseract_cmd,),
+            )
+        return _pool
+
+def _reset_pool(broken: concurrent.futures.ProcessPoolExecutor):
+    # после падения процесса (BrokenProcessPool) пул непригоден — следующий вызов создаст новый.
+    # Сбрасываем только тот пул, что сломался: другой поток актора мог уже заменить его
+    # новым и работать с ним.
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
 
 # --------------------------
 # Помощники для зеркалирования структуры IN_DIR → OUT_DIR
@@ -151,6 +175,7 @@ def ocr_file(file_path: str):
         if ext == ".pdf":
             logger.info(f"OCR PDF (hybrid): {file_path}")
 
+            # Один открытый src на всё: классификация, рендер сканов и сборка выходного PDF
             # 1) Определяем страницы с текстом и собираем текстовый слой
             with fitz.open(file_path) as src:
                 page_count = src.page_count
@@ -167,46 +192,69 @@ def ocr_file(file_path: str):
                     else:
                         is_scan_page[n] = True  # позже сделаем OCR
 
-            # 2) OCR только скан-страниц (параллельно)
-            ocr_results: dict[int, Tuple[str, bytes]] = {}
-            scan_indices = [i for i, flag in enumerate(is_scan_page) if flag]
-            if scan_indices:
-                logger.info(f"Scanning pages via OCR: {len(scan_indices)}")
-                def run_ocr(n: int) -> Tuple[int, str, bytes]:
-                    img = render_page_to_image(file_path, n, dpi=OCR_DPI)
-                    txt, pdf_bytes = ocr_image_to_text_and_pdf(img)
-                    return n, txt, pdf_bytes
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=OCR_THREADS) as pool:
-                    futures = [pool.submit(run_ocr, n) for n in scan_indices]
-                    for fut in concurrent.futures.as_completed(futures):
-                        n, txt, pdf_bytes = fut.result()
-                        ocr_results[n] = (txt, pdf_bytes)
-                        text_per_page[n] = preprocess_text_layer(txt)
-
-            # 3) TXT
-            if OUTPUT_TXT:
-                os.makedirs(os.path.dirname(out_txt_path), exist_ok=True)
-                with open(out_txt_path, "w", encoding="utf-8") as f:
-                    for n, page_text in enumerate(text_per_page):
-                        if n > 0:
-                            f.write("\n\n")
-                        f.write(page_text or "")
+                # 2) OCR только скан-страниц (параллельно)
+                ocr_results: dict[int, Tuple[str, bytes]] = {}
+                scan_indices = [i for i, flag in enumerate(is_scan_page) if flag]
+                if scan_indices:
+                    logger.info(f"Scanning pages via OCR: {len(scan_indices)}")
+                    # небольшие пачки (~4 на процесс): пул общий для всех потоков актора,
+                    # и крупный документ не должен занимать все процессы до конца своего OCR
+                    batch_size = max(1, len(scan_indices) // OCR_THREADS // 4)
+                    batches = [scan_indices[i:i + batch_size] for i in range(0, len(scan_indices), batch_size)]
+                    pool = _get_pool()
+                    futures: List[concurrent.futures.Future] = []
+                    try:
+                        for batch in batches:
+                            futures.append(pool.submit(
+                                ocr.ocr_pages, file_path, batch, OCR_DPI, OCR_LANG, TESSERACT_CONFIG,
+                                OCR_MAX_SIDE_PX, OCR_COLORSPACE != "rgb",
+                            ))
+                        for fut in concurrent.futures.as_completed(futures):
+                            for n, txt, pdf_bytes in fut.result():
+                                ocr_results[n] = (txt, pdf_bytes)
+                                text_per_page[n] = preprocess_text_layer(txt)
+                    except BaseException as e:
+                        # Остальные пачки этого файла: снимаем ещё не начатые и дожидаемся идущих —
+                        # их процессы держат file_path открытым, и на Windows move_to_err не сможет
+                        # его переместить (а OCR обречённого файла — пустая работа).
+                        for f in futures:
+                            f.cancel()
+                        concurrent.futures.wait(futures)
+                        if isinstance(e, concurrent.futures.BrokenExecutor):
+                            _reset_pool(pool)
+                        raise
 
-            # 4) PDF
-            if OUTPUT_PDF:
-                os.makedirs(os.path.dirname(out_pdf_path), exist_ok=True)
-                with fitz.open(file_path) as src, fitz.open() as outdoc:
-                    for n in range(src.page_count):
-                        if not is_scan_page[n]:
-                            # Копируем исходную страницу (текстовый слой сохранится)
-                            outdoc.insert_pdf(src, from_page=n, to_page=n)
-                        else:
-                            # Вставляем одностраничный OCR-PDF
-                            txt_pdf = ocr_results[n][1]
-                            with fitz.open(stream=txt_pdf, filetype="pdf") as ocr_page_doc:
-                                outdoc.insert_pdf(ocr_page_doc)
-                    outdoc.save(out_pdf_path)
+                # 3) TXT
+                if OUTPUT_TXT:
+                    os.makedirs(os.path.dirname(out_txt_path), exist_ok=True)
+                    with open(out_txt_path, "w", encoding="utf-8") as f:
+                        f.write("\n\n".join(page_text or "" for page_text in text_per_page))
+
+                # 4) PDF — тот же src, без повторного открытия
+                if OUTPUT_PDF and not scan_indices:
+                    # сканов нет — результат совпадает с исходником: копируем файл как есть
+                    os.makedirs(os.path.dirname(out_pdf_path), exist_ok=True)
+                    shutil.copyfile(file_path, out_pdf_path)
+                elif OUTPUT_PDF:
+                    os.makedirs(os.path.dirname(out_pdf_path), exist_ok=True)
+                    with fitz.open() as outdoc:
+                        n = 0
+                        while n < page_count:
+                            if not is_scan_page[n]:
+                                # Копируем подряд идущие текстовые страницы одним диапазоном
+                                # (текстовый слой сохранится)
+                                hi = n
+                                while hi + 1 < page_count and not is_scan_page[hi + 1]:
+                                    hi += 1
+                                outdoc.insert_pdf(src, from_page=n, to_page=hi)
+                                n = hi + 1
+                            else:
+                                # Вставляем одностраничный OCR-PDF
+                                txt_pdf = ocr_results[n][1]
+                                with fitz.open(stream=txt_pdf, filetype="pdf") as ocr_page_doc:
+                                    outdoc.insert_pdf(ocr_page_doc)
+                                n += 1
+                        outdoc.save(out_pdf_path)
 
             logger.info(f"OCR done: {file_path} -> {os.path.dirname(out_txt_path)}")
 
@@ -216,7 +264,7 @@ def ocr_file(file_path: str):
             # --------------------------
             logger.info(f"OCR Image: {file_path}")
             img = Image.open(file_path)
-            txt, pdf_bytes = ocr_image_to_text_and_pdf(img)
+            txt, pdf_bytes = ocr.ocr_image_to_text_and_pdf(img, OCR_LANG, TESSERACT_CONFIG)
             txt = preprocess_text_layer(txt)
 
             if OUTPUT_TXT:
@@ -234,3 +282,61 @@ def ocr_file(file_path: str):
     except Exception as e:
         logger.exception(f"OCR failed: {file_path}: {e}")
         move_to_err(file_path, str(e))
+
+# --------------------------
+# Пакетная постановка в очередь
+# Pipeline повторяет внутренности RedisBroker.enqueue конкретной версии dramatiq
+# (скрипт dispatch, _max_unpack_size, _should_do_maintenance). На другой версии
+# не гадаем о формате аргументов — громко предупреждаем и ставим по одному.
+# --------------------------
+_PIPELINE_DRAMATIQ = "1.16."
+_pipeline_enqueue = (
+    isinstance(broker, RedisBroker)
+    and dramatiq.__version__.startswith(_PIPELINE_DRAMATIQ)
+    and "dispatch" in getattr(broker, "scripts", {})
+    and hasattr(broker, "_max_unpack_size")
+    and hasattr(broker, "_should_do_maintenance")
+)
+if isinstance(broker, RedisBroker) and not _pipeline_enqueue:
+    logger.warning(
+        f"dramatiq {dramatiq.__version__}: pipelined enqueue supports {_PIPELINE_DRAMATIQ}x only — "
+        f"falling back to one ocr_file.send per file"
+    )
+
+def send_ocr_batch(paths: List[str]) -> None:
+    """
+    Ставит ocr_file для пачки путей одним pipeline в Redis: один RTT на пачку вместо RTT на файл.
+    Повторяет RedisBroker.enqueue (dramatiq 1.16, без delay), но копит вызовы скрипта dispatch в pipeline.
+    """
+    if not paths:
+        return
+    if not _pipeline_enqueue:
+        for path in paths:
+            ocr_file.send(path)
+        return
+
+    dispatch = broker.scripts["dispatch"]
+    keys = [broker.namespace]
+    max_unpack = broker._max_unpack_size()   # может сходить в Redis сам — до pipeline
+    messages = []
+    with broker.client.pipeline(transaction=False) as pipe:
+        for path in paths:
+            # как и в enqueue: уникальный redis_message_id на каждую постановку
+            message = ocr_file.message(path).copy(options={"redis_message_id": str(uuid4())})
+            broker.emit_before("enqueue", message, None)
+            dispatch(keys=keys, client=pipe, args=[
+                "enqueue",
+                current_millis(),
+                message.queue_name,
+                broker.broker_id,
+                broker.heartbeat_timeout,
+                broker.dead_message_ttl,
+                broker._should_do_maintenance("enqueue"),
+                max_unpack,
+                message.options["redis_message_id"],
+                message.encode(),
+            ])
+            messages.append(message)
+        pipe.execute()
+    for message in messages:
+        broker.emit_after("enqueue", message, None)